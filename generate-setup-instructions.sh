@@ -9,16 +9,19 @@ required_vars=(
     "AWS_ACCOUNT_ID"
     "AWS_REGION"
     "S3_BUCKET"
+    "AMI_ID"
 )
 
 # Optional environment variables (with defaults)
-AMI_ID=${AMI_ID:-"ami-022acf3cdef3c76c1"}  # Amazon Linux 2023 ARM64
 INSTANCE_TYPE=${INSTANCE_TYPE:-"c8g.metal-24xl"}
 IAM_INSTANCE_PROFILE=${IAM_INSTANCE_PROFILE:-"ecsInstanceRole"}
 LAMBDA_FUNCTION_NAME=${LAMBDA_FUNCTION_NAME:-"proof-of-reserves-launcher"}
 LAMBDA_ROLE_NAME=${LAMBDA_ROLE_NAME:-"ProofOfReservesLambdaRole"}
+SQS_QUEUE_NAME=${SQS_QUEUE_NAME:-"proof-of-reserves-events"}
 EC2_ROLE_NAME=${EC2_ROLE_NAME:-"ProofOfReservesEC2Role"}
 EC2_KEY_NAME=${EC2_KEY_NAME:-""}  # Optional: EC2 key pair name for SSH access
+SUBNET_ID=${SUBNET_ID:-""}  # Optional: subnet to launch proof instances in
+PLACEMENT_GROUP=${PLACEMENT_GROUP:-""}  # Optional: placement group for proof instances
 
 # Check for missing required variables
 missing_vars=()
@@ -38,15 +41,18 @@ if [ ${#missing_vars[@]} -ne 0 ]; then
     echo "  export AWS_ACCOUNT_ID=\"123456789012\""
     echo "  export AWS_REGION=\"us-east-1\""
     echo "  export S3_BUCKET=\"my-bucket\""
+    echo "  export AMI_ID=\"ami-0123456789abcdef0\"  # Built with packer/plonky2-por.pkr.hcl"
     echo ""
     echo "Optional variables (defaults shown):"
-    echo "  export AMI_ID=\"$AMI_ID\""
     echo "  export INSTANCE_TYPE=\"$INSTANCE_TYPE\""
     echo "  export IAM_INSTANCE_PROFILE=\"$IAM_INSTANCE_PROFILE\""
     echo "  export LAMBDA_FUNCTION_NAME=\"$LAMBDA_FUNCTION_NAME\""
     echo "  export LAMBDA_ROLE_NAME=\"$LAMBDA_ROLE_NAME\""
+    echo "  export SQS_QUEUE_NAME=\"$SQS_QUEUE_NAME\""
     echo "  export EC2_ROLE_NAME=\"$EC2_ROLE_NAME\""
     echo "  export EC2_KEY_NAME=\"my-key-pair\"  # Optional for SSH access"
+    echo "  export SUBNET_ID=\"subnet-0123456789abcdef0\"  # Optional"
+    echo "  export PLACEMENT_GROUP=\"por-cluster\"  # Optional"
     echo ""
     echo "Then run: $0"
     exit 1
@@ -65,6 +71,7 @@ Configuration:
   AWS Account ID: $AWS_ACCOUNT_ID
   AWS Region: $AWS_REGION
   S3 Bucket: $S3_BUCKET
+  AMI ID: $AMI_ID
   Instance Type: $INSTANCE_TYPE
 
 ======================================================================
@@ -130,6 +137,9 @@ aws iam create-role --role-name $LAMBDA_ROLE_NAME --assume-role-policy-document
 # Attach basic execution role to Lambda
 aws iam attach-role-policy --role-name $LAMBDA_ROLE_NAME --policy-arn arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole
 
+# Allow Lambda to consume the S3 event queue
+aws iam attach-role-policy --role-name $LAMBDA_ROLE_NAME --policy-arn arn:aws:iam::aws:policy/service-role/AWSLambdaSQSQueueExecutionRole
+
 # Attach custom policy to Lambda role
 aws iam put-role-policy --role-name $LAMBDA_ROLE_NAME --policy-name LambdaEC2Policy --policy-document '{
   "Version": "2012-10-17",
@@ -167,28 +177,44 @@ aws lambda create-function \\
   --handler launch_ec2_lambda.lambda_handler \\
   --zip-file fileb://lambda-function.zip \\
   --timeout 60 \\
-  --environment Variables="{AMI_ID=$AMI_ID,INSTANCE_TYPE=$INSTANCE_TYPE,IAM_INSTANCE_PROFILE=$IAM_INSTANCE_PROFILE,S3_BUCKET=$S3_BUCKET,AWS_ACCOUNT_ID=$AWS_ACCOUNT_ID,TARGET_REGION=$AWS_REGION,EC2_KEY_NAME=$EC2_KEY_NAME}"
+  --environment Variables="{AMI_ID=$AMI_ID,INSTANCE_TYPE=$INSTANCE_TYPE,IAM_INSTANCE_PROFILE=$IAM_INSTANCE_PROFILE,S3_BUCKET=$S3_BUCKET,AWS_ACCOUNT_ID=$AWS_ACCOUNT_ID,TARGET_REGION=$AWS_REGION,EC2_KEY_NAME=$EC2_KEY_NAME,SUBNET_ID=$SUBNET_ID,PLACEMENT_GROUP=$PLACEMENT_GROUP}"
 
 ======================================================================
 3. CONFIGURE S3 EVENT TRIGGER
 ======================================================================
 
-# Add S3 trigger permission to Lambda function
-aws lambda add-permission \\
-  --function-name $LAMBDA_FUNCTION_NAME \\
-  --principal s3.amazonaws.com \\
-  --action lambda:InvokeFunction \\
-  --statement-id s3-trigger-permission \\
-  --source-arn arn:aws:s3:::$S3_BUCKET
+# S3 events are buffered in an SQS queue so a single Lambda invocation
+# launches instances for up to 10 uploads at once
+
+# Create a dead-letter queue for events that keep failing to launch
+aws sqs create-queue \\
+  --queue-name $SQS_QUEUE_NAME-dlq \\
+  --attributes MessageRetentionPeriod=1209600
+
+# Create the event queue (visibility timeout must exceed the Lambda timeout);
+# events move to the dead-letter queue after 3 failed deliveries
+aws sqs create-queue \\
+  --queue-name $SQS_QUEUE_NAME \\
+  --attributes '{
+    "VisibilityTimeout": "360",
+    "RedrivePolicy": "{\\"deadLetterTargetArn\\":\\"arn:aws:sqs:$AWS_REGION:$AWS_ACCOUNT_ID:$SQS_QUEUE_NAME-dlq\\",\\"maxReceiveCount\\":\\"3\\"}"
+  }'
+
+# Allow S3 to send events to the queue
+aws sqs set-queue-attributes \\
+  --queue-url https://sqs.$AWS_REGION.amazonaws.com/$AWS_ACCOUNT_ID/$SQS_QUEUE_NAME \\
+  --attributes '{
+    "Policy": "{\\"Version\\":\\"2012-10-17\\",\\"Statement\\":[{\\"Effect\\":\\"Allow\\",\\"Principal\\":{\\"Service\\":\\"s3.amazonaws.com\\"},\\"Action\\":\\"sqs:SendMessage\\",\\"Resource\\":\\"arn:aws:sqs:$AWS_REGION:$AWS_ACCOUNT_ID:$SQS_QUEUE_NAME\\",\\"Condition\\":{\\"ArnEquals\\":{\\"aws:SourceArn\\":\\"arn:aws:s3:::$S3_BUCKET\\"}}}]}"
+  }'
 
 # Configure S3 bucket notification
 aws s3api put-bucket-notification-configuration \\
   --bucket $S3_BUCKET \\
   --notification-configuration '{
-    "LambdaFunctionConfigurations": [
+    "QueueConfigurations": [
       {
         "Id": "proof-of-reserves-trigger",
-        "LambdaFunctionArn": "arn:aws:lambda:$AWS_REGION:$AWS_ACCOUNT_ID:function:$LAMBDA_FUNCTION_NAME",
+        "QueueArn": "arn:aws:sqs:$AWS_REGION:$AWS_ACCOUNT_ID:$SQS_QUEUE_NAME",
         "Events": ["s3:ObjectCreated:*"],
         "Filter": {
           "Key": {
@@ -204,6 +230,14 @@ aws s3api put-bucket-notification-configuration \\
     ]
   }'
 
+# Deliver queued events to the Lambda function in batches
+aws lambda create-event-source-mapping \\
+  --function-name $LAMBDA_FUNCTION_NAME \\
+  --event-source-arn arn:aws:sqs:$AWS_REGION:$AWS_ACCOUNT_ID:$SQS_QUEUE_NAME \\
+  --batch-size 10 \\
+  --maximum-batching-window-in-seconds 30 \\
+  --function-response-types ReportBatchItemFailures
+
 ======================================================================
 4. TEST THE SETUP
 ======================================================================
@@ -225,12 +259,10 @@ The system will now automatically process any private_ledger.json files
 uploaded to s3://$S3_BUCKET/
 
 The EC2 instances will:
-1. Install Rust nightly toolchain
-2. Clone and build plonky2_por from source
-3. Download the private_ledger.json from S3
-4. Generate proofs using the bare metal performance
-5. Upload results back to S3
-6. Terminate themselves
+1. Download the private_ledger.json from S3
+2. Generate proofs with the plonky2_por binary baked into the AMI
+3. Upload results back to S3
+4. Terminate themselves
 
 Monitor the system:
 - Lambda logs: /aws/lambda/$LAMBDA_FUNCTION_NAME
@@ -255,7 +287,7 @@ aws lambda update-function-code \\
 # Update environment variables (if needed)
 aws lambda update-function-configuration \\
   --function-name $LAMBDA_FUNCTION_NAME \\
-  --environment Variables="{AMI_ID=$AMI_ID,INSTANCE_TYPE=$INSTANCE_TYPE,IAM_INSTANCE_PROFILE=$IAM_INSTANCE_PROFILE,S3_BUCKET=$S3_BUCKET,AWS_ACCOUNT_ID=$AWS_ACCOUNT_ID,TARGET_REGION=$AWS_REGION,EC2_KEY_NAME=$EC2_KEY_NAME}"
+  --environment Variables="{AMI_ID=$AMI_ID,INSTANCE_TYPE=$INSTANCE_TYPE,IAM_INSTANCE_PROFILE=$IAM_INSTANCE_PROFILE,S3_BUCKET=$S3_BUCKET,AWS_ACCOUNT_ID=$AWS_ACCOUNT_ID,TARGET_REGION=$AWS_REGION,EC2_KEY_NAME=$EC2_KEY_NAME,SUBNET_ID=$SUBNET_ID,PLACEMENT_GROUP=$PLACEMENT_GROUP}"
 
 # View the updated function
 aws lambda get-function --function-name $LAMBDA_FUNCTION_NAME
@@ -1,69 +1,88 @@
 import boto3
+import functools
+import hashlib
+import json
 import os
-
-ec2 = boto3.client('ec2')
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from string import Template
+from urllib.parse import unquote_plus
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 
 # Configuration variables - all required
-AMI_ID = os.environ.get('AMI_ID')
-INSTANCE_TYPE = os.environ.get('INSTANCE_TYPE')
-IAM_INSTANCE_PROFILE = os.environ.get('IAM_INSTANCE_PROFILE')
-S3_BUCKET = os.environ.get('S3_BUCKET')
-AWS_ACCOUNT_ID = os.environ.get('AWS_ACCOUNT_ID')
-TARGET_REGION = os.environ.get('TARGET_REGION')
+_REQUIRED_VARS = ('AMI_ID', 'INSTANCE_TYPE', 'IAM_INSTANCE_PROFILE', 'S3_BUCKET', 'AWS_ACCOUNT_ID', 'TARGET_REGION')
+_required_values = tuple(os.environ.get(var_name) for var_name in _REQUIRED_VARS)
 EC2_KEY_NAME = os.environ.get('EC2_KEY_NAME')  # Optional
+SUBNET_ID = os.environ.get('SUBNET_ID')  # Optional
+PLACEMENT_GROUP = os.environ.get('PLACEMENT_GROUP')  # Optional
 
 # Check that all required environment variables are set
-required_vars = {
-    'AMI_ID': AMI_ID,
-    'INSTANCE_TYPE': INSTANCE_TYPE,
-    'IAM_INSTANCE_PROFILE': IAM_INSTANCE_PROFILE,
-    'S3_BUCKET': S3_BUCKET,
-    'AWS_ACCOUNT_ID': AWS_ACCOUNT_ID,
-    'TARGET_REGION': TARGET_REGION
-}
-
-missing_vars = [var_name for var_name, var_value in required_vars.items() if not var_value]
+missing_vars = [var_name for var_name, var_value in zip(_REQUIRED_VARS, _required_values) if not var_value]
 if missing_vars:
     raise ValueError(f"Missing required environment variables: {', '.join(missing_vars)}")
 
-user_data_template = f"""#!/bin/bash
+AMI_ID, INSTANCE_TYPE, IAM_INSTANCE_PROFILE, S3_BUCKET, AWS_ACCOUNT_ID, TARGET_REGION = _required_values
+
+# proof_dir is interpolated into the root user data script, so only allow
+# characters that are inert inside a double-quoted bash string
+_PROOF_DIR_PATTERN = re.compile(r'[A-Za-z0-9._/-]+')
+
+# Created on first invocation rather than at import, then reused by warm
+# invocations so they share pooled HTTPS connections
+_ec2 = None
+
+
+def _get_ec2():
+    global _ec2
+    if _ec2 is None:
+        _ec2 = boto3.client('ec2', config=Config(
+            region_name=TARGET_REGION,
+            max_pool_connections=50,
+            retries={'mode': 'adaptive', 'max_attempts': 10},
+            tcp_keepalive=True
+        ))
+    return _ec2
+
+
+_USER_DATA_RAW = """#!/bin/bash
 set -euo pipefail
 
-S3_BUCKET="{S3_BUCKET}"
-PROOF_DIR="{{{{PROOF_DIR}}}}"
-REGION="{TARGET_REGION}"
-USER_PROOFS_ALWAYS="true"
+S3_BUCKET="%(S3_BUCKET)s"
+PROOF_DIR="$proof_dir"
+REGION="%(REGION)s"
 
 # Log all output
 exec > >(tee /var/log/user-data.log)
 exec 2>&1
 
+# Look up the instance ID once via IMDSv2 for self-termination at the end
+IMDS_TOKEN=$(curl -sX PUT -H "X-aws-ec2-metadata-token-ttl-seconds: 21600" http://169.254.169.254/latest/api/token)
+INSTANCE_ID=$(curl -sH "X-aws-ec2-metadata-token: $IMDS_TOKEN" http://169.254.169.254/latest/meta-data/instance-id)
+
 echo "Starting bare metal proof processing..."
 echo "S3 Bucket: $S3_BUCKET"
 echo "Proof Directory: $PROOF_DIR"
 
-# Update system and install dependencies
-yum update -y
-yum install -y git gcc gcc-c++ make openssl-devel awscli zip
-
-# Install Rust (as ec2-user)
-su - ec2-user -c "curl --proto '=https' --tlsv1.2 -sSf https://sh.rustup.rs | sh -s -- -y --default-toolchain nightly"
-
-# Clone and build plonky2_por
-su - ec2-user -c "
-    source ~/.cargo/env
-    cd ~
-    git clone https://github.com/otter-sec/por_v2
-    cd por_v2
-    cargo build --release --bin plonky2_por
-"
+# plonky2_por is pre-built into the AMI (see packer/plonky2-por.pkr.hcl)
+if [ ! -x /home/ec2-user/por_v2/target/release/plonky2_por ]; then
+    echo "Error: plonky2_por binary not found - AMI_ID must point to the pre-built image"
+    exit 1
+fi
 
-# Create 16GB ramdisk for working directory
-echo "Setting up 16GB ramdisk for /workspace..."
+# Create ramdisk for working directory
+# ramfs is never swapped and skips tmpfs size accounting; it does not enforce
+# a size limit, so the instance must have enough RAM for the ledger and proofs
+echo "Setting up ramdisk for /workspace..."
 mkdir -p /workspace
-mount -t tmpfs -o size=16G tmpfs /workspace
+mount -t ramfs ramfs /workspace
 chown ec2-user:ec2-user /workspace
-echo "16GB ramdisk mounted at /workspace"
+echo "ramdisk mounted at /workspace"
+
+# Tune the AWS CLI for parallel multipart S3 transfers
+aws configure set default.s3.max_concurrent_requests 32
+aws configure set default.s3.multipart_chunksize 64MB
+aws configure set default.s3.max_queue_size 10000
 
 # Download private_ledger.json from S3
 echo "Downloading private_ledger.json from S3..."
@@ -96,9 +115,10 @@ fi
 echo "Proof generation completed successfully"
 
 # Create proofs.zip containing the main proof files
+# -1 is the fastest deflate level; JSON still compresses well at that setting
 echo "Creating proofs.zip..."
 cd /workspace
-zip proofs.zip merkle_tree.json final_proof.json
+zip -1 proofs.zip merkle_tree.json final_proof.json
 
 if [ ! -f "proofs.zip" ]; then
     echo "Error: Failed to create proofs.zip"
@@ -107,84 +127,163 @@ fi
 
 echo "Successfully created proofs.zip"
 
-# Check if we should upload user proofs
-UPLOAD_USER_PROOFS=false
-if [ "$USER_PROOFS_ALWAYS" = "true" ]; then
-    UPLOAD_USER_PROOFS=true
-else
-    CURRENT_MINUTE=$(date -u +"%H%M")
-    if [ "$CURRENT_MINUTE" -ge "2355" ] || [ "$CURRENT_MINUTE" -le "0005" ]; then
-        UPLOAD_USER_PROOFS=true
-    fi
-fi
-
-# Generate user inclusion proofs if needed
-if [ "$UPLOAD_USER_PROOFS" = "true" ]; then
-    echo "Generating user inclusion proofs..."
-    su - ec2-user -c "
-        cd /workspace
-        ~/por_v2/target/release/plonky2_por prove-inclusion --all-batched
-    "
-    echo "User inclusion proofs generated"
-fi
+# Generate user inclusion proofs
+echo "Generating user inclusion proofs..."
+su - ec2-user -c "
+    cd /workspace
+    ~/por_v2/target/release/plonky2_por prove-inclusion --all-batched
+"
+echo "User inclusion proofs generated"
 
-# Upload all files back to S3
+# Upload the known outputs and proofs.zip (with public read access) in parallel;
+# wait on each PID so a failed upload still aborts under set -e
 echo "Uploading results back to S3..."
-aws s3 sync /workspace "s3://$S3_BUCKET/$PROOF_DIR/" --region $REGION --exclude "private_ledger.json" --exclude "proofs.zip"
+UPLOAD_PIDS=()
+for f in merkle_tree.json final_proof.json; do
+    aws s3 cp "/workspace/$f" "s3://$S3_BUCKET/$PROOF_DIR/$f" --region $REGION --no-progress &
+    UPLOAD_PIDS+=($!)
+done
+
+if [ -d /workspace/user_proofs ]; then
+    aws s3 cp /workspace/user_proofs "s3://$S3_BUCKET/$PROOF_DIR/user_proofs/" --recursive --region $REGION --no-progress &
+    UPLOAD_PIDS+=($!)
+fi
 
-# Upload proofs.zip with public read access
 echo "Uploading proofs.zip with public access..."
-aws s3 cp /workspace/proofs.zip "s3://$S3_BUCKET/$PROOF_DIR/proofs.zip" --region $REGION --acl public-read
+aws s3 cp /workspace/proofs.zip "s3://$S3_BUCKET/$PROOF_DIR/proofs.zip" --region $REGION --acl public-read --no-progress &
+UPLOAD_PIDS+=($!)
+
+for pid in "${UPLOAD_PIDS[@]}"; do
+    wait $pid
+done
 
 echo "Proof processing completed successfully!"
 echo "Results uploaded to: s3://$S3_BUCKET/$PROOF_DIR/"
 echo "Public download URL: https://$S3_BUCKET.s3.$REGION.amazonaws.com/$PROOF_DIR/proofs.zip"
 
 # Terminate the instance
-INSTANCE_ID=$(curl -s http://169.254.169.254/latest/meta-data/instance-id)
 aws ec2 terminate-instances --instance-ids $INSTANCE_ID --region $REGION
 """
 
+# Stable values are filled in once per container; $proof_dir is substituted per record
+user_data_template = _USER_DATA_RAW % {'S3_BUCKET': S3_BUCKET, 'REGION': TARGET_REGION}
+
+# Compiled once per container; safe_substitute leaves the script's own $VARS untouched
+USER_DATA_TPL = Template(user_data_template)
+
+
+@functools.lru_cache(maxsize=64)
+def _render_user_data(proof_dir):
+    # botocore base64-encodes UserData for RunInstances itself, so cache the plain script
+    return USER_DATA_TPL.safe_substitute(proof_dir=proof_dir)
+
+
+def _s3_records(event):
+    # S3 notifications arrive wrapped in SQS messages; each body is a full S3 event.
+    # S3's test event has no Records and yields nothing. Yields (message_id, record),
+    # with message_id None when invoked directly by S3.
+    for message in event['Records']:
+        if message.get('eventSource') == 'aws:sqs':
+            for record in json.loads(message['body']).get('Records', []):
+                yield message['messageId'], record
+        else:
+            yield None, message
+
+
 def lambda_handler(event, context):
     launched_instances = []
+    errors = []
+    failed_message_ids = []
+    launches = []
 
-    for record in event['Records']:
+    for message_id, record in _s3_records(event):
         bucket = record['s3']['bucket']['name']
-        key = record['s3']['object']['key']
+        # S3 event keys are URL-encoded
+        key = unquote_plus(record['s3']['object']['key'])
+
+        if not key.endswith('/private_ledger.json'):
+            print(f"Skipping S3 key that is not a private_ledger.json in a proof directory: {key}")
+            continue
 
         # Extract the directory path from the S3 key (remove the filename)
         # For example: "proof-runs/2024-01-15/private_ledger.json" -> "proof-runs/2024-01-15"
         proof_dir = '/'.join(key.split('/')[:-1])
 
+        if not _PROOF_DIR_PATTERN.fullmatch(proof_dir):
+            print(f"Rejecting S3 key with unsupported characters in proof directory: {key}")
+            errors.append({'key': key, 'error': 'Unsupported characters in proof directory'})
+            continue
+
         # Substitute PROOF_DIR in user data
-        user_data = user_data_template.replace('{{PROOF_DIR}}', proof_dir)
-
-        try:
-            # Build the run_instances parameters
-            run_params = {
-                'ImageId': AMI_ID,
-                'InstanceType': INSTANCE_TYPE,
-                'IamInstanceProfile': {'Name': IAM_INSTANCE_PROFILE},
-                'UserData': user_data,
-                'MinCount': 1,
-                'MaxCount': 1
+        user_data = _render_user_data(proof_dir)
+
+        # Idempotency token so a retried delivery of the same S3 event returns the
+        # already-launched instance instead of starting another one. The sequencer
+        # differs between uploads, so re-uploading a ledger still launches.
+        sequencer = record['s3']['object'].get('sequencer', '')
+        client_token = hashlib.sha256(f"{bucket}/{key}/{sequencer}".encode()).hexdigest()
+
+        # Build the run_instances parameters
+        run_params = {
+            'ImageId': AMI_ID,
+            'InstanceType': INSTANCE_TYPE,
+            'IamInstanceProfile': {'Name': IAM_INSTANCE_PROFILE},
+            'UserData': user_data,
+            'MinCount': 1,
+            'MaxCount': 1,
+            'ClientToken': client_token
+        }
+
+        # Add KeyName only if EC2_KEY_NAME is provided
+        if EC2_KEY_NAME:
+            run_params['KeyName'] = EC2_KEY_NAME
+
+        # Launch into a specific subnet (with a public IP for S3 access) if provided
+        if SUBNET_ID:
+            run_params['NetworkInterfaces'] = [{
+                'DeviceIndex': 0,
+                'SubnetId': SUBNET_ID,
+                'InterfaceType': 'interface',
+                'AssociatePublicIpAddress': True
+            }]
+
+        # Add Placement only if PLACEMENT_GROUP is provided
+        if PLACEMENT_GROUP:
+            run_params['Placement'] = {'GroupName': PLACEMENT_GROUP}
+
+        launches.append((message_id, key, run_params))
+
+    # Launch all instances concurrently over the shared client's connection pool.
+    # A failed launch is recorded and does not abort the rest of the batch.
+    if launches:
+        ec2 = _get_ec2()
+        with ThreadPoolExecutor(max_workers=min(16, len(launches))) as executor:
+            futures = {
+                executor.submit(ec2.run_instances, **run_params): (message_id, key)
+                for message_id, key, run_params in launches
             }
 
-            # Add KeyName only if EC2_KEY_NAME is provided
-            if EC2_KEY_NAME:
-                run_params['KeyName'] = EC2_KEY_NAME
-
-            response = ec2.run_instances(**run_params)
-
-            instance_id = response['Instances'][0]['InstanceId']
-            launched_instances.append(instance_id)
-            print(f"Launched EC2 instance {instance_id} for S3 key: {key}")
-
-        except Exception as e:
-            print(f"Failed to launch instance for {key}: {str(e)}")
-            raise e
+            for future in as_completed(futures):
+                message_id, key = futures[future]
+                try:
+                    response = future.result()
+                except (ClientError, BotoCoreError) as e:
+                    print(f"Failed to launch instance for {key}: {str(e)}")
+                    errors.append({'key': key, 'error': str(e)})
+                    if message_id is not None and message_id not in failed_message_ids:
+                        failed_message_ids.append(message_id)
+                    continue
+
+                instance_id = response['Instances'][0]['InstanceId']
+                launched_instances.append(instance_id)
+                print(f"Launched EC2 instance {instance_id} for S3 key: {key}")
 
     return {
         'statusCode': 200,
-        'body': f'Successfully launched {len(launched_instances)} instance(s): {launched_instances}'
-    }
\ No newline at end of file
+        'body': f'Launched {len(launched_instances)} instance(s): {launched_instances}, {len(errors)} failed',
+        'launched_instances': launched_instances,
+        'errors': errors,
+        # Only the failed SQS messages are redelivered (ReportBatchItemFailures);
+        # the ClientToken makes relaunching their records safe
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_message_ids]
+    }
@@ -0,0 +1,102 @@
+# Builds the AMI used by the proof-of-reserves EC2 instances.
+#
+# The image ships with the Rust nightly toolchain and a release build of
+# plonky2_por at /home/ec2-user/por_v2/target/release/plonky2_por, so the
+# launched instances only download the ledger, prove and upload.
+#
+# plonky2_por is built from a pinned source tarball in S3 rather than a git
+# clone; create it from the por_v2 checkout to deploy:
+#   git archive --format=tar.gz --prefix=por_v2/ -o por_v2-src.tar.gz <ref>
+#   aws s3 cp por_v2-src.tar.gz s3://<bucket>/assets/por_v2-src.tar.gz
+#
+# Usage:
+#   packer init packer/plonky2-por.pkr.hcl
+#   packer build -var "region=us-east-1" -var "s3_bucket=<bucket>" packer/plonky2-por.pkr.hcl
+
+packer {
+  required_plugins {
+    amazon = {
+      version = ">= 1.2.0"
+      source  = "github.com/hashicorp/amazon"
+    }
+  }
+}
+
+variable "region" {
+  type    = string
+  default = "us-east-1"
+}
+
+variable "instance_type" {
+  type    = string
+  default = "c8g.4xlarge"
+}
+
+variable "s3_bucket" {
+  type = string
+}
+
+variable "source_tarball_key" {
+  type    = string
+  default = "assets/por_v2-src.tar.gz"
+}
+
+source "amazon-ebs" "plonky2_por" {
+  region        = var.region
+  instance_type = var.instance_type
+  ssh_username  = "ec2-user"
+  ami_name      = "plonky2-por-{{timestamp}}"
+
+  # Temporary profile created for the build so it can read the source tarball
+  temporary_iam_instance_profile_policy_document {
+    Version = "2012-10-17"
+    Statement {
+      Effect   = "Allow"
+      Action   = ["s3:GetObject"]
+      Resource = ["arn:aws:s3:::${var.s3_bucket}/${var.source_tarball_key}"]
+    }
+  }
+
+  # Enhanced networking for S3 transfer throughput on the proof instances
+  ena_support = true
+
+  # Amazon Linux 2023 ARM64
+  source_ami_filter {
+    filters = {
+      name                = "al2023-ami-2023.*-arm64"
+      root-device-type    = "ebs"
+      virtualization-type = "hvm"
+    }
+    owners      = ["amazon"]
+    most_recent = true
+  }
+
+  tags = {
+    Name    = "plonky2-por"
+    Purpose = "proof-of-reserves"
+  }
+}
+
+build {
+  sources = ["source.amazon-ebs.plonky2_por"]
+
+  # Install system dependencies
+  provisioner "shell" {
+    inline = [
+      "sudo yum update -y",
+      "sudo yum install -y gcc gcc-c++ make openssl-devel awscli zip"
+    ]
+  }
+
+  # Install Rust nightly and build plonky2_por from the pinned source tarball
+  provisioner "shell" {
+    inline = [
+      "curl --proto '=https' --tlsv1.2 -sSf https://sh.rustup.rs | sh -s -- -y --default-toolchain nightly",
+      "source ~/.cargo/env",
+      "aws s3 cp s3://${var.s3_bucket}/${var.source_tarball_key} /tmp/por_v2-src.tar.gz --region ${var.region}",
+      "tar -xzf /tmp/por_v2-src.tar.gz -C ~",
+      "cd ~/por_v2",
+      "cargo build --release --bin plonky2_por"
+    ]
+  }
+}